@@ -1,121 +1,172 @@
 # -*- coding: utf-8 -*-
 from django.conf import settings
-
-from zerver.lib.test_classes import ZulipTestCase, UploadSerializeMixin
-from zerver.lib.test_helpers import use_s3_backend, override_settings
-
-from io import StringIO
-from boto.s3.connection import S3Connection
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.test import Client
+
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import override_settings
+from zerver.lib.thumbnail import generate_thumbnail_url
+from zerver.lib.upload import LocalUploadBackend, S3UploadBackend
+from zerver.models import Realm, get_realm, get_user
+import zerver.lib.upload
+
+from moto import mock_s3, mock_s3_deprecated
+import boto3
+import functools
+import mock
+import os
+import shutil
+import tempfile
 import ujson
 import urllib
 import base64
 
+# These tests only read the uri of each upload back, so there is no
+# point in having the upload backend sync the file contents to disk;
+# point LOCAL_UPLOADS_DIR at a fresh directory under tmpfs where
+# available, so the writes stay in RAM and concurrent runs can't
+# collide.  ThumbnailTest.tearDownClass removes it again.  (The
+# /thumbnail endpoint never serves the file itself, so the URL-pattern
+# caveat in UploadSerializeMixin doesn't apply here.)
+TEST_UPLOADS_DIR = tempfile.mkdtemp(
+    prefix='zulip-test-thumbnail-uploads-',
+    dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+BASE = '/user_uploads/'
+BASE_LEN = len(BASE)
+
+# The payload for every upload in this module; bytes are immutable, so
+# one shared object serves all the SimpleUploadedFile wrappers.
+SHARED_UPLOAD_BYTES = b"zulip!"
+
+# The fixed pieces of every expected thumbor URL, interned once here
+# instead of being re-materialized inside each test's format strings.
+THUMBNAIL_URL = '/thumbnail?url='
+SIZE_ORIGINAL = '&size=original'
+SIZE_THUMBNAIL = '&size=thumbnail'
+SMART_PREFIX = '/smart/filters:no_upscale()/'
+SRC_EXTERNAL = '/source_type/external'
+SRC_LOCAL = '/source_type/local_file'
+SRC_S3 = '/source_type/s3'
+THUMB_PREFIX = '/0x100'
+
+@functools.lru_cache(maxsize=64)
+def _b64url(s: str) -> str:
+    # The tests below encode the same handful of URIs over and over;
+    # base64 is a pure transform, so memoize it by input string.
+    return base64.urlsafe_b64encode(s.encode()).decode('utf-8')
+
+def _uri_from_upload(response: HttpResponse) -> str:
+    # We need a real JSON parse here: ujson.dumps escapes non-ASCII
+    # filenames (like the unicode upload below) as \uXXXX sequences,
+    # which a naive scrape of the response bytes would hand back
+    # un-decoded.
+    return ujson.loads(response.content)["uri"]
+
+def _thumbor_urlpart(uri: str, source_type: str, size: str='') -> str:
+    # The piece of the thumbor URL the tests below expect to find in
+    # the redirect for an upload at `uri`, parametrized on one of the
+    # SRC_* constants so we don't need a near-identical closure per test.
+    url_in_result = SMART_PREFIX + _b64url(uri[BASE_LEN:]) + source_type
+    if size:
+        url_in_result = '/' + size + url_in_result
+    return url_in_result
+
+@override_settings(LOCAL_UPLOADS_DIR=TEST_UPLOADS_DIR)
 class ThumbnailTest(ZulipTestCase):
 
-    @use_s3_backend
-    def test_s3_source_type(self) -> None:
-        def get_file_path_urlpart(uri: str, size: str='') -> str:
-            base = '/user_uploads/'
-            url_in_result = 'smart/filters:no_upscale()/%s/source_type/s3'
-            if size:
-                url_in_result = '/%s/%s' % (size, url_in_result)
-            upload_file_path = uri[len(base):]
-            hex_uri = base64.urlsafe_b64encode(upload_file_path.encode()).decode('utf-8')
-            return url_in_result % (hex_uri)
-
-        conn = S3Connection(settings.S3_KEY, settings.S3_SECRET_KEY)
-        conn.create_bucket(settings.S3_AUTH_UPLOADS_BUCKET)
-
-        self.login(self.example_email("hamlet"))
-        fp = StringIO("zulip!")
-        fp.name = "zulip.jpeg"
-
-        result = self.client_post("/json/user_uploads", {'file': fp})
-        self.assert_json_success(result)
-        json = ujson.loads(result.content)
-        self.assertIn("uri", json)
-        uri = json["uri"]
-        base = '/user_uploads/'
-        self.assertEqual(base, uri[:len(base)])
-
-        quoted_uri = urllib.parse.quote(uri[1:], safe='')
-
-        # Test original image size.
-        result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        expected_part_url = get_file_path_urlpart(uri)
-        self.assertIn(expected_part_url, result.url)
-
-        # Test thumbnail size.
-        result = self.client_get("/thumbnail?url=%s&size=thumbnail" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        expected_part_url = get_file_path_urlpart(uri, '0x100')
-        self.assertIn(expected_part_url, result.url)
-
-        # Tests the /api/v1/thumbnail api endpoint with standard API auth
-        self.logout()
-        result = self.api_get(
-            self.example_email("hamlet"),
-            '/thumbnail?url=%s&size=original' %
-            (quoted_uri,))
-        self.assertEqual(result.status_code, 302, result)
-        expected_part_url = get_file_path_urlpart(uri)
-        self.assertIn(expected_part_url, result.url)
-
-        # Test with another user trying to access image using thumbor.
-        self.login(self.example_email("iago"))
-        result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
-        self.assertEqual(result.status_code, 403, result)
-        self.assert_in_response("You are not authorized to view this file.", result)
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree(TEST_UPLOADS_DIR, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self) -> None:
+        super().setUp()
+        # The /thumbnail endpoint only assembles redirect URLs; it
+        # should never talk to thumbor (or anything else) itself.  If a
+        # regression changes that, fail fast here instead of having
+        # these tests silently start waiting on socket timeouts.
+        patcher = mock.patch(
+            'requests.sessions.Session.request',
+            side_effect=AssertionError('Unexpected outbound HTTP request in a thumbnail test'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        # Upload the test image once for the whole class; the local-file
+        # tests below only exercise the read-only /thumbnail endpoint,
+        # so there is no reason for each of them to repeat the POST.
+        # Django rolls back each test's changes to this shared state.
+        #
+        # We also resolve the UserProfile objects once here, so that the
+        # tests can use the much cheaper force_login instead of running
+        # the whole password-hashing pipeline on every login call.
+        realm = get_realm('zulip')
+        cls.hamlet = get_user(cls.example_user_map['hamlet'], realm)
+        cls.iago = get_user(cls.example_user_map['iago'], realm)
+        fp = SimpleUploadedFile("zulip.jpeg", SHARED_UPLOAD_BYTES, "image/jpeg")
+        django_client = Client()  # see WRAPPER_COMMENT
+        django_client.force_login(cls.hamlet)
+        result = django_client.post(
+            "/json/user_uploads", {'file': fp},
+            HTTP_HOST=Realm.host_for_subdomain(cls.DEFAULT_SUBDOMAIN))
+        assert result.status_code == 200
+        cls.shared_uri = _uri_from_upload(result)
+        assert cls.shared_uri.startswith('/user_uploads/')
+        # We remove the forward slash infront of the `/user_uploads/` to
+        # match bugdown behaviour.
+        cls.shared_quoted_uri = urllib.parse.quote(cls.shared_uri[1:], safe='')
+        # The two endpoint URLs every local-file test requests, built
+        # once instead of re-quoting and re-formatting in each test.
+        cls.thumb_url_original = THUMBNAIL_URL + cls.shared_quoted_uri + SIZE_ORIGINAL
+        cls.thumb_url_thumbnail = THUMBNAIL_URL + cls.shared_quoted_uri + SIZE_THUMBNAIL
 
     def test_external_source_type(self) -> None:
         def run_test_with_image_url(image_url: str) -> None:
-            # Test original image size.
-            self.login(self.example_email("hamlet"))
+            self.client.force_login(self.hamlet)
             quoted_url = urllib.parse.quote(image_url, safe='')
-            encoded_url = base64.urlsafe_b64encode(image_url.encode()).decode('utf-8')
-            result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_url))
+            # Compute the expected URL fragments once; every assertion
+            # below checks for one of these two strings.
+            encoded_url = _b64url(image_url)
+            expected_original = SMART_PREFIX + encoded_url + SRC_EXTERNAL
+            expected_thumb = THUMB_PREFIX + expected_original
+            url_original = THUMBNAIL_URL + quoted_url + SIZE_ORIGINAL
+            url_thumbnail = THUMBNAIL_URL + quoted_url + SIZE_THUMBNAIL
+
+            # Test original image size.
+            result = self.client_get(url_original)
             self.assertEqual(result.status_code, 302, result)
-            expected_part_url = '/smart/filters:no_upscale()/' + encoded_url + '/source_type/external'
-            self.assertIn(expected_part_url, result.url)
+            self.assertIn(expected_original, result.url)
 
             # Test thumbnail size.
-            result = self.client_get("/thumbnail?url=%s&size=thumbnail" % (quoted_url))
+            result = self.client_get(url_thumbnail)
             self.assertEqual(result.status_code, 302, result)
-            expected_part_url = '/0x100/smart/filters:no_upscale()/' + encoded_url + '/source_type/external'
-            self.assertIn(expected_part_url, result.url)
+            self.assertIn(expected_thumb, result.url)
 
             # Test api endpoint with standard API authentication.
             self.logout()
-            user_profile = self.example_user("hamlet")
-            result = self.api_get(user_profile.email,
-                                  "/thumbnail?url=%s&size=thumbnail" % (quoted_url,))
+            result = self.api_get(self.hamlet.email, url_thumbnail)
             self.assertEqual(result.status_code, 302, result)
-            expected_part_url = '/0x100/smart/filters:no_upscale()/' + encoded_url + '/source_type/external'
-            self.assertIn(expected_part_url, result.url)
+            self.assertIn(expected_thumb, result.url)
 
             # Test api endpoint with legacy API authentication.
-            user_profile = self.example_user("hamlet")
-            result = self.client_get("/thumbnail?url=%s&size=thumbnail&api_key=%s" % (
-                quoted_url, user_profile.api_key))
+            result = self.client_get(url_thumbnail + '&api_key=' + self.hamlet.api_key)
             self.assertEqual(result.status_code, 302, result)
-            expected_part_url = '/0x100/smart/filters:no_upscale()/' + encoded_url + '/source_type/external'
-            self.assertIn(expected_part_url, result.url)
+            self.assertIn(expected_thumb, result.url)
 
             # Test a second logged-in user; they should also be able to access it
-            user_profile = self.example_user("iago")
-            result = self.client_get("/thumbnail?url=%s&size=thumbnail&api_key=%s" % (quoted_url, user_profile.api_key))
+            result = self.client_get(url_thumbnail + '&api_key=' + self.iago.api_key)
             self.assertEqual(result.status_code, 302, result)
-            expected_part_url = '/0x100/smart/filters:no_upscale()/' + encoded_url + '/source_type/external'
-            self.assertIn(expected_part_url, result.url)
+            self.assertIn(expected_thumb, result.url)
 
             # Test with another user trying to access image using thumbor.
             # File should be always accessible to user in case of external source
-            self.login(self.example_email("iago"))
-            result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_url))
+            self.client.force_login(self.iago)
+            result = self.client_get(url_original)
             self.assertEqual(result.status_code, 302, result)
-            expected_part_url = '/smart/filters:no_upscale()/' + encoded_url + '/source_type/external'
-            self.assertIn(expected_part_url, result.url)
+            self.assertIn(expected_original, result.url)
 
         image_url = 'https://images.foobar.com/12345'
         run_test_with_image_url(image_url)
@@ -124,197 +175,205 @@ class ThumbnailTest(ZulipTestCase):
         run_test_with_image_url(image_url)
 
     def test_local_file_type(self) -> None:
-        def get_file_path_urlpart(uri: str, size: str='') -> str:
-            base = '/user_uploads/'
-            url_in_result = 'smart/filters:no_upscale()/%s/source_type/local_file'
-            if size:
-                url_in_result = '/%s/%s' % (size, url_in_result)
-            upload_file_path = uri[len(base):]
-            hex_uri = base64.urlsafe_b64encode(upload_file_path.encode()).decode('utf-8')
-            return url_in_result % (hex_uri)
-
-        self.login(self.example_email("hamlet"))
-        fp = StringIO("zulip!")
-        fp.name = "zulip.jpeg"
-
-        result = self.client_post("/json/user_uploads", {'file': fp})
-        self.assert_json_success(result)
-        json = ujson.loads(result.content)
-        self.assertIn("uri", json)
-        uri = json["uri"]
-        base = '/user_uploads/'
-        self.assertEqual(base, uri[:len(base)])
-
-        # Test original image size.
-        # We remove the forward slash infront of the `/user_uploads/` to match
-        # bugdown behaviour.
-        quoted_uri = urllib.parse.quote(uri[1:], safe='')
-        result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        expected_part_url = get_file_path_urlpart(uri)
-        self.assertIn(expected_part_url, result.url)
-
-        # Test thumbnail size.
-        result = self.client_get("/thumbnail?url=%s&size=thumbnail" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        expected_part_url = get_file_path_urlpart(uri, '0x100')
-        self.assertIn(expected_part_url, result.url)
+        self.client.force_login(self.hamlet)
+        uri = self.shared_uri
+
+        # Test both sizes with standard session auth.
+        for url, expected_part_url in [
+            (self.thumb_url_original, _thumbor_urlpart(uri, SRC_LOCAL)),
+            (self.thumb_url_thumbnail, _thumbor_urlpart(uri, SRC_LOCAL, '0x100')),
+        ]:
+            result = self.client_get(url)
+            self.assertEqual(result.status_code, 302, result)
+            self.assertIn(expected_part_url, result.url)
 
         # Test with a unicode filename.
-        fp = StringIO("zulip!")
-        fp.name = "μένει.jpg"
-
+        fp = SimpleUploadedFile("μένει.jpg", SHARED_UPLOAD_BYTES, "image/jpeg")
         result = self.client_post("/json/user_uploads", {'file': fp})
         self.assert_json_success(result)
-        json = ujson.loads(result.content)
-        self.assertIn("uri", json)
-        uri = json["uri"]
+        uri = _uri_from_upload(result)
 
         # We remove the forward slash infront of the `/user_uploads/` to match
         # bugdown behaviour.
         quoted_uri = urllib.parse.quote(uri[1:], safe='')
-        result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        expected_part_url = get_file_path_urlpart(uri)
-        self.assertIn(expected_part_url, result.url)
-        self.logout()
-
-        # Tests the /api/v1/thumbnail api endpoint with HTTP basic auth.
-        user_profile = self.example_user("hamlet")
-        result = self.api_get(
-            self.example_email("hamlet"),
-            '/thumbnail?url=%s&size=original' %
-            (quoted_uri,))
-        self.assertEqual(result.status_code, 302, result)
-        expected_part_url = get_file_path_urlpart(uri)
-        self.assertIn(expected_part_url, result.url)
-
-        # Tests the /api/v1/thumbnail api endpoint with ?api_key
-        # auth.
-        user_profile = self.example_user("hamlet")
-        result = self.client_get(
-            '/thumbnail?url=%s&size=original&api_key=%s' %
-            (quoted_uri, user_profile.api_key))
-        self.assertEqual(result.status_code, 302, result)
-        expected_part_url = get_file_path_urlpart(uri)
-        self.assertIn(expected_part_url, result.url)
+        url = THUMBNAIL_URL + quoted_uri + SIZE_ORIGINAL
+        expected_part_url = _thumbor_urlpart(uri, SRC_LOCAL)
+
+        # The same request should succeed with session auth, with HTTP
+        # basic auth on the /api/v1/thumbnail endpoint, and with ?api_key
+        # auth; drive all three from one table.
+        for auth_mode in ['session', 'basic', 'api_key']:
+            if auth_mode == 'session':
+                result = self.client_get(url)
+            elif auth_mode == 'basic':
+                self.logout()
+                result = self.api_get(self.hamlet.email, url)
+            else:
+                result = self.client_get(url + '&api_key=' + self.hamlet.api_key)
+            self.assertEqual(result.status_code, 302, (auth_mode, result))
+            self.assertIn(expected_part_url, result.url)
 
         # Test with another user trying to access image using thumbor.
-        self.login(self.example_email("iago"))
-        result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
+        self.client.force_login(self.iago)
+        result = self.client_get(url)
         self.assertEqual(result.status_code, 403, result)
         self.assert_in_response("You are not authorized to view this file.", result)
 
-    @override_settings(THUMBOR_URL='127.0.0.1:9995')
-    def test_with_static_files(self) -> None:
-        self.login(self.example_email("hamlet"))
-        uri = '/static/images/cute/turtle.png'
-        quoted_uri = urllib.parse.quote(uri[1:], safe='')
-        result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        self.assertEqual(uri, result.url)
+    def test_with_different_sizes(self) -> None:
+        self.client.force_login(self.hamlet)
+        quoted_uri = self.shared_quoted_uri
+
+        # Test with size supplied as a query parameter where size is anything
+        # else than original or thumbnail. Result should be an error message.
+        result = self.client_get(THUMBNAIL_URL + quoted_uri + '&size=480x360')
+        self.assertEqual(result.status_code, 403, result)
+        self.assert_in_response("Invalid size.", result)
 
-    def test_with_thumbor_disabled(self) -> None:
-        self.login(self.example_email("hamlet"))
-        fp = StringIO("zulip!")
-        fp.name = "zulip.jpeg"
+        # Test with no size param supplied. In this case as well we show an
+        # error message.
+        result = self.client_get(THUMBNAIL_URL + quoted_uri)
+        self.assertEqual(result.status_code, 400, "Missing 'size' argument")
 
-        result = self.client_post("/json/user_uploads", {'file': fp})
-        self.assert_json_success(result)
-        json = ujson.loads(result.content)
-        self.assertIn("uri", json)
-        uri = json["uri"]
-        base = '/user_uploads/'
-        self.assertEqual(base, uri[:len(base)])
 
-        quoted_uri = urllib.parse.quote(uri[1:], safe='')
+class ThumbnailS3Test(ZulipTestCase):
+    # The S3 test lives in its own narrowly scoped class so that the
+    # moto mock and bucket are only set up when it actually runs, and
+    # so the local-file class above can be scheduled on a different
+    # test-backend worker without contending for these fixtures.
+    #
+    # Neither thumbnail class takes UploadSerializeMixin: its lock only
+    # protects tests sharing the on-disk var/ uploads directory, and
+    # our uploads go to moto's in-memory S3 here and to the class's own
+    # tmpfs directory above, so serializing them would just cost
+    # parallelism.
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        # Starting the moto mocks and creating the S3 bucket are
+        # expensive enough that we do them once for the whole class,
+        # rather than paying the setup cost in every test.  mock_s3
+        # only intercepts botocore traffic; the upload backend itself
+        # talks boto2, so we need mock_s3_deprecated active as well.
+        cls._mock_s3 = mock_s3()
+        cls._mock_s3.start()
+        cls._mock_s3_deprecated = mock_s3_deprecated()
+        cls._mock_s3_deprecated.start()
+        cls._s3_client = boto3.client('s3', region_name='us-east-1')
+        cls._s3_bucket = cls._s3_client.create_bucket(
+            Bucket=settings.S3_AUTH_UPLOADS_BUCKET)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls._mock_s3_deprecated.stop()
+        cls._mock_s3.stop()
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        realm = get_realm('zulip')
+        cls.hamlet = get_user(cls.example_user_map['hamlet'], realm)
+        cls.iago = get_user(cls.example_user_map['iago'], realm)
+
+    @override_settings(LOCAL_UPLOADS_DIR=None)
+    def test_s3_source_type(self) -> None:
+        # We can't use the use_s3_backend decorator here, since starting
+        # a fresh moto mock per test would discard the bucket created in
+        # setUpClass; instead, we just swap in the S3 backend ourselves.
+        zerver.lib.upload.upload_backend = S3UploadBackend()
+        try:
+            self.client.force_login(self.hamlet)
+            fp = SimpleUploadedFile("zulip.jpeg", SHARED_UPLOAD_BYTES, "image/jpeg")
+            result = self.client_post("/json/user_uploads", {'file': fp})
+            self.assert_json_success(result)
+            uri = _uri_from_upload(result)
+            base = '/user_uploads/'
+            self.assertEqual(base, uri[:len(base)])
 
-        with self.settings(THUMBOR_URL=''):
-            result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        self.assertEqual(uri, result.url)
-
-        uri = 'https://www.google.com/images/srpr/logo4w.png'
-        quoted_uri = urllib.parse.quote(uri, safe='')
-        with self.settings(THUMBOR_URL=''):
-            result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        self.assertEqual(uri, result.url)
-
-        uri = 'http://www.google.com/images/srpr/logo4w.png'
-        quoted_uri = urllib.parse.quote(uri, safe='')
-        with self.settings(THUMBOR_URL=''):
-            result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        base = 'https://external-content.zulipcdn.net/7b6552b60c635e41e8f6daeb36d88afc4eabde79/687474703a2f2f7777772e676f6f676c652e636f6d2f696d616765732f737270722f6c6f676f34772e706e67'
-        self.assertEqual(base, result.url)
-
-    def test_with_different_THUMBOR_URL(self) -> None:
-        self.login(self.example_email("hamlet"))
-        fp = StringIO("zulip!")
-        fp.name = "zulip.jpeg"
+            quoted_uri = urllib.parse.quote(uri[1:], safe='')
+            url_original = THUMBNAIL_URL + quoted_uri + SIZE_ORIGINAL
 
-        result = self.client_post("/json/user_uploads", {'file': fp})
-        self.assert_json_success(result)
-        json = ujson.loads(result.content)
-        self.assertIn("uri", json)
-        uri = json["uri"]
-        base = '/user_uploads/'
-        self.assertEqual(base, uri[:len(base)])
+            # Test original image size.
+            result = self.client_get(url_original)
+            self.assertEqual(result.status_code, 302, result)
+            expected_part_url = _thumbor_urlpart(uri, SRC_S3)
+            self.assertIn(expected_part_url, result.url)
 
-        quoted_uri = urllib.parse.quote(uri[1:], safe='')
-        hex_uri = base64.urlsafe_b64encode(uri[len('/user_uploads/'):].encode()).decode('utf-8')
-        with self.settings(THUMBOR_URL='http://test-thumborhost.com'):
-            result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        base = 'http://test-thumborhost.com/'
-        self.assertEqual(base, result.url[:len(base)])
-        expected_part_url = '/smart/filters:no_upscale()/' + hex_uri + '/source_type/local_file'
-        self.assertIn(expected_part_url, result.url)
+            # Test thumbnail size.
+            result = self.client_get(THUMBNAIL_URL + quoted_uri + SIZE_THUMBNAIL)
+            self.assertEqual(result.status_code, 302, result)
+            expected_part_url = _thumbor_urlpart(uri, SRC_S3, '0x100')
+            self.assertIn(expected_part_url, result.url)
 
-    def test_with_different_sizes(self) -> None:
-        def get_file_path_urlpart(uri: str, size: str='') -> str:
-            base = '/user_uploads/'
-            url_in_result = 'smart/filters:no_upscale()/%s/source_type/local_file'
-            if size:
-                url_in_result = '/%s/%s' % (size, url_in_result)
-            upload_file_path = uri[len(base):]
-            hex_uri = base64.urlsafe_b64encode(upload_file_path.encode()).decode('utf-8')
-            return url_in_result % (hex_uri)
+            # Tests the /api/v1/thumbnail api endpoint with standard API auth
+            self.logout()
+            result = self.api_get(self.hamlet.email, url_original)
+            self.assertEqual(result.status_code, 302, result)
+            expected_part_url = _thumbor_urlpart(uri, SRC_S3)
+            self.assertIn(expected_part_url, result.url)
 
-        self.login(self.example_email("hamlet"))
-        fp = StringIO("zulip!")
-        fp.name = "zulip.jpeg"
+            # Test with another user trying to access image using thumbor.
+            self.client.force_login(self.iago)
+            result = self.client_get(url_original)
+            self.assertEqual(result.status_code, 403, result)
+            self.assert_in_response("You are not authorized to view this file.", result)
+        finally:
+            zerver.lib.upload.upload_backend = LocalUploadBackend()
+
+
+class ThumbnailURLBuilderTest(ZulipTestCase):
+    # Most of what the /thumbnail tests above assert on is really the
+    # output of generate_thumbnail_url, a pure function of its
+    # arguments and the THUMBOR_*/upload settings.  Testing it directly
+    # avoids paying for the whole request/response pipeline on every
+    # permutation; the classes above keep one end-to-end test per
+    # source_type (plus the authorization checks, which do need the
+    # view).
 
-        result = self.client_post("/json/user_uploads", {'file': fp})
-        self.assert_json_success(result)
-        json = ujson.loads(result.content)
-        self.assertIn("uri", json)
-        uri = json["uri"]
-        base = '/user_uploads/'
-        self.assertEqual(base, uri[:len(base)])
-
-        # Test with size supplied as a query parameter.
-        # size=thumbnail should return a 0x100 sized image.
-        # size=original should return the original resolution image.
-        quoted_uri = urllib.parse.quote(uri[1:], safe='')
-        result = self.client_get("/thumbnail?url=%s&size=thumbnail" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        expected_part_url = get_file_path_urlpart(uri, '0x100')
-        self.assertIn(expected_part_url, result.url)
+    def test_local_file_type(self) -> None:
+        url = generate_thumbnail_url('user_uploads/1/de/cUfytyr/zulip.jpeg')
+        self.assertIn(_thumbor_urlpart('/user_uploads/1/de/cUfytyr/zulip.jpeg', SRC_LOCAL), url)
+        url = generate_thumbnail_url('user_uploads/1/de/cUfytyr/zulip.jpeg', '0x100')
+        self.assertIn(_thumbor_urlpart('/user_uploads/1/de/cUfytyr/zulip.jpeg', SRC_LOCAL, '0x100'), url)
 
-        result = self.client_get("/thumbnail?url=%s&size=original" % (quoted_uri))
-        self.assertEqual(result.status_code, 302, result)
-        expected_part_url = get_file_path_urlpart(uri)
-        self.assertIn(expected_part_url, result.url)
+    def test_s3_source_type(self) -> None:
+        with self.settings(LOCAL_UPLOADS_DIR=None):
+            url = generate_thumbnail_url('user_uploads/1/de/cUfytyr/zulip.jpeg')
+        self.assertIn(_thumbor_urlpart('/user_uploads/1/de/cUfytyr/zulip.jpeg', SRC_S3), url)
 
-        # Test with size supplied as a query parameter where size is anything
-        # else than original or thumbnail. Result should be an error message.
-        result = self.client_get("/thumbnail?url=%s&size=480x360" % (quoted_uri))
-        self.assertEqual(result.status_code, 403, result)
-        self.assert_in_response("Invalid size.", result)
+    def test_external_source_type(self) -> None:
+        # Both https:// and http:// URLs are external sources.
+        for image_url in ['https://images.foobar.com/12345',
+                          'http://images.foobar.com/12345']:
+            expected_original = SMART_PREFIX + _b64url(image_url) + SRC_EXTERNAL
+            url = generate_thumbnail_url(image_url)
+            self.assertIn(expected_original, url)
+            url = generate_thumbnail_url(image_url, '0x100')
+            self.assertIn(THUMB_PREFIX + expected_original, url)
 
-        # Test with no size param supplied. In this case as well we show an
-        # error message.
-        result = self.client_get("/thumbnail?url=%s" % (quoted_uri))
-        self.assertEqual(result.status_code, 400, "Missing 'size' argument")
+    @override_settings(THUMBOR_URL='127.0.0.1:9995')
+    def test_static_files(self) -> None:
+        # Static resources are never thumbnailed.
+        url = generate_thumbnail_url('static/images/cute/turtle.png')
+        self.assertEqual(url, '/static/images/cute/turtle.png')
+
+    @override_settings(THUMBOR_URL='')
+    def test_thumbor_disabled(self) -> None:
+        url = generate_thumbnail_url('user_uploads/1/de/cUfytyr/zulip.jpeg')
+        self.assertEqual(url, '/user_uploads/1/de/cUfytyr/zulip.jpeg')
+
+        url = generate_thumbnail_url('https://www.google.com/images/srpr/logo4w.png')
+        self.assertEqual(url, 'https://www.google.com/images/srpr/logo4w.png')
+
+        # http:// URLs are still proxied through camo.
+        url = generate_thumbnail_url('http://www.google.com/images/srpr/logo4w.png')
+        self.assertEqual(
+            url,
+            'https://external-content.zulipcdn.net/7b6552b60c635e41e8f6daeb36d88afc4eabde79/687474703a2f2f7777772e676f6f676c652e636f6d2f696d616765732f737270722f6c6f676f34772e706e67')
+
+    @override_settings(THUMBOR_URL='http://test-thumborhost.com')
+    def test_different_thumbor_url(self) -> None:
+        url = generate_thumbnail_url('user_uploads/1/de/cUfytyr/zulip.jpeg')
+        base = 'http://test-thumborhost.com/'
+        self.assertEqual(base, url[:len(base)])
+        self.assertIn(_thumbor_urlpart('/user_uploads/1/de/cUfytyr/zulip.jpeg', SRC_LOCAL), url)